@@ -1,53 +1,206 @@
+import leidenalg
 import louvain
-from math import log
+from math import log, log1p
 import numpy as np
 from scipy.optimize import fsolve
 import warnings
 
+try:
+    from numba import get_num_threads, njit, prange
+except ImportError:
+    njit = None
+
+# the community detection runs are seeded so that estimates are reproducible and a partition found earlier in the
+# iteration is the one that would be found again for the same resolution parameters
+_RNG_SEED = 0
+
+
+class _ScratchBuffer(object):
+    """
+    Reusable work array for per-iteration accumulators whose size varies with the number of communities. The
+    backing storage only grows (by half again beyond what is requested) so that it is rarely reallocated.
+    """
+
+    def __init__(self):
+        self._data = np.zeros(0)
+
+    def zeros(self, *shape):
+        size = int(np.prod(shape))
+        if self._data.size < size:
+            self._data = np.empty(int(1.5 * size))
+        out = self._data[:size].reshape(shape)
+        out.fill(0)
+        return out
+
+
+def _membership_array(partition):
+    """
+    Converts a partition's membership list to the int32 array indexed by the edge-sum kernels. np.fromiter with a
+    known count fills the array directly, skipping the type inference pass of np.asarray.
+    """
+    membership = partition.membership
+    return np.fromiter(membership, dtype=np.int32, count=len(membership))
+
+
+def _intralayer_sums_numpy(srcs, tgts, ws, edge_layer, layer_offsets, community, m_t_in, kappa_t_r):
+    """
+    Accumulates the membership-dependent sums over intralayer edges needed for the SBM parameter estimates. The edges
+    are expected to be sorted by layer.
+
+    :param srcs: source vertex of each edge
+    :param tgts: target vertex of each edge
+    :param ws: weight of each edge
+    :param edge_layer: layer of each edge
+    :param layer_offsets: start of each layer's slice of edges, followed by the total number of edges
+    :param community: community of each vertex
+    :param m_t_in: zeroed length T output for the per-layer weight of within-community edges
+    :param kappa_t_r: zeroed T x K output for the per-layer community degrees
+    """
+    T, K = kappa_t_r.shape
+    comm_srcs, comm_tgts = community[srcs], community[tgts]
+    m_t_in += np.bincount(edge_layer, weights=ws * (comm_srcs == comm_tgts), minlength=T)
+
+    # kappa_t_r is accumulated as a flattened (T, K) array keyed by layer * K + community (with the edges sorted by
+    # layer, these keys only move forward through the array)
+    layer_offset = edge_layer * K
+    kappa_flat = kappa_t_r.reshape(-1)
+    kappa_flat += np.bincount(layer_offset + comm_srcs, weights=ws, minlength=T * K)
+    kappa_flat += np.bincount(layer_offset + comm_tgts, weights=ws, minlength=T * K)
+
+
+def _intralayer_sums_loop(srcs, tgts, ws, edge_layer, layer_offsets, community, m_t_in, kappa_t_r):
+    """
+    Single-pass equivalent of _intralayer_sums_numpy, written as an explicit loop for compilation with numba. Each
+    layer's edges are a contiguous slice, so only that layer's row of kappa_t_r is written while they are visited.
+    """
+    for t in range(kappa_t_r.shape[0]):
+        m_in = 0.0
+        for i in range(layer_offsets[t], layer_offsets[t + 1]):
+            r, s, w = community[srcs[i]], community[tgts[i]], ws[i]
+            if r == s:
+                m_in += w
+            kappa_t_r[t, r] += w
+            kappa_t_r[t, s] += w
+        m_t_in[t] += m_in
+
+
+def _intralayer_sums_chunked(srcs, tgts, ws, edge_layer, layer_offsets, community, m_t_in, kappa_t_r, partials):
+    """
+    Parallel equivalent of _intralayer_sums_loop for compilation with numba. The edges are split into one contiguous
+    chunk per row of the zeroed n_chunks x T x (K + 1) array partials, whose first K columns accumulate that chunk's
+    kappa_t_r and whose last column accumulates its m_t_in. The chunks are then added together one layer per thread.
+    """
+    T, K = kappa_t_r.shape
+    n_edges = ws.shape[0]
+    n_chunks = partials.shape[0]
+    chunk_size = (n_edges + n_chunks - 1) // n_chunks
+    for c in prange(n_chunks):
+        for i in range(c * chunk_size, min((c + 1) * chunk_size, n_edges)):
+            t, r, s, w = edge_layer[i], community[srcs[i]], community[tgts[i]], ws[i]
+            if r == s:
+                partials[c, t, K] += w
+            partials[c, t, r] += w
+            partials[c, t, s] += w
+
+    for t in prange(T):
+        for c in range(n_chunks):
+            m_t_in[t] += partials[c, t, K]
+            for r in range(K):
+                kappa_t_r[t, r] += partials[c, t, r]
+
+
+# below this many edges, starting threads and reducing their partial sums costs more than it saves
+_PARALLEL_MIN_EDGES = 200000
+# the per-thread partial sums must also be small next to the edge count, or zeroing and reducing them dominates (with
+# many layers and communities they can outnumber the edges themselves)
+_PARALLEL_EDGES_PER_PARTIAL = 8
+
+# the explicit loops avoid the temporaries of the numpy version, but are only worthwhile when compiled
+if njit is not None:
+    _intralayer_sums_serial = njit(cache=True, fastmath=True)(_intralayer_sums_loop)
+    _intralayer_sums_parallel = njit(cache=True, fastmath=True, parallel=True)(_intralayer_sums_chunked)
+
+    def _intralayer_sums(srcs, tgts, ws, edge_layer, layer_offsets, community, m_t_in, kappa_t_r, partial_buffer):
+        n_edges, n_threads = ws.shape[0], get_num_threads()
+        T, K = kappa_t_r.shape
+        if n_edges >= _PARALLEL_MIN_EDGES and n_threads > 1 and \
+                n_threads * T * (K + 1) * _PARALLEL_EDGES_PER_PARTIAL <= n_edges:
+            _intralayer_sums_parallel(srcs, tgts, ws, edge_layer, layer_offsets, community, m_t_in, kappa_t_r,
+                                      partial_buffer.zeros(n_threads, T, K + 1))
+        else:
+            _intralayer_sums_serial(srcs, tgts, ws, edge_layer, layer_offsets, community, m_t_in, kappa_t_r)
+else:
+    def _intralayer_sums(srcs, tgts, ws, edge_layer, layer_offsets, community, m_t_in, kappa_t_r, partial_buffer):
+        _intralayer_sums_numpy(srcs, tgts, ws, edge_layer, layer_offsets, community, m_t_in, kappa_t_r)
+
 
 def iterative_monolayer_resolution_parameter_estimation(G, gamma=1.0, tol=1e-2, max_iter=25, verbose=False):
     """
     Monolayer variant of ALG. 1 from "Relating modularity maximization and stochastic block models in multilayer
     networks." The nested functions here are just used to match the pseudocode in the paper.
 
+    The Leiden runs are seeded with a fixed value, so repeated calls on the same graph return the same result.
+
     :param G: input graph
     :param gamma: starting gamma value
     :param tol: convergence tolerance
     :param max_iter: maximum number of iterations
-    :param verbose: whether or not to print verbose output
+    :param verbose: whether or not to print verbose output (this computes the modularity of every partition found,
+                    an extra pass over the edges per iteration)
     :return: gamma to which the iteration converged and the resulting partition
     """
 
     if 'weight' not in G.es:
-        G.es['weight'] = [1.0] * G.ecount()
-    m = sum(G.es['weight'])
+        G.es['weight'] = 1.0
+
+    # edge endpoints and weights do not change between iterations, so they are gathered into arrays once
+    edges = np.array(G.get_edgelist(), dtype=np.int32).reshape(-1, 2)
+    srcs, tgts = edges[:, 0], edges[:, 1]
+    ws = np.asarray(G.es['weight'], dtype=np.float64)
+    m = float(ws.sum())
+    # a monolayer network is a single layer
+    edge_layer, layer_offsets = np.zeros(len(ws), dtype=np.int32), np.array([0, len(ws)])
+    m_t_in, kappa_buffer, partial_buffer = np.zeros(1), _ScratchBuffer(), _ScratchBuffer()
+    last_estimate = [None, None]  # membership (as bytes) and the estimates computed for it
+
+    # partitions already found in this run, keyed by rounded resolution parameter, so that revisiting a gamma does
+    # not rerun the optimization
+    partitions = {}
 
     def maximize_modularity(resolution_param):
         # RBConfigurationVertexPartition implements sum (A_ij - gamma (k_ik_j)/(2m)) delta(sigma_i, sigma_j)
         # i.e. "standard" modularity with resolution parameter
-        return louvain.find_partition(G, louvain.RBConfigurationVertexPartition, resolution_parameter=resolution_param,
-                                      weights='weight')
+        key = round(resolution_param, 6)
+        if key not in partitions:
+            partitions[key] = leidenalg.find_partition(G, leidenalg.RBConfigurationVertexPartition,
+                                                       resolution_parameter=resolution_param, weights='weight',
+                                                       seed=_RNG_SEED)
+        return partitions[key]
 
     def estimate_SBM_parameters(partition):
-        community = partition.membership
-        m_in = sum(e['weight'] * (community[e.source] == community[e.target]) for e in G.es)
-        kappa_r_list = [0] * len(partition)
-        for e in G.es:
-            kappa_r_list[community[e.source]] += e['weight']
-            kappa_r_list[community[e.target]] += e['weight']
-        sum_kappa_sqr = sum(x ** 2 for x in kappa_r_list)
+        K = len(partition)
+        community = _membership_array(partition)
+        # the graph is fixed, so the estimates only change if the membership does
+        membership_key = community.tobytes()
+        if membership_key == last_estimate[0]:
+            return last_estimate[1]
+
+        m_t_in.fill(0)
+        kappa_t_r = kappa_buffer.zeros(1, K)
+        _intralayer_sums(srcs, tgts, ws, edge_layer, layer_offsets, community, m_t_in, kappa_t_r, partial_buffer)
+        m_in = float(m_t_in[0])
+        sum_kappa_sqr = float(np.dot(kappa_t_r[0], kappa_t_r[0]))
 
         omega_in = (2 * m_in) / (sum_kappa_sqr / (2 * m))
         # guard for div by zero with single community partition
         omega_out = (2 * m - 2 * m_in) / (2 * m - sum_kappa_sqr / (2 * m)) if len(partition) > 1 else 0
 
         # return estimates for omega_in, omega_out (for multilayer, this would return theta_in, theta_out, p, K)
+        last_estimate[:] = membership_key, (omega_in, omega_out)
         return omega_in, omega_out
 
-    def update_gamma(omega_in, omega_out):
-        if omega_out == 0:
-            return omega_in / log(omega_in)
-        return (omega_in - omega_out) / (log(omega_in) - log(omega_out))
+    def update_gamma(omega_in, omega_out, log_omega_ratio):
+        return (omega_in - omega_out) / log_omega_ratio
 
     part, last_gamma = None, None
     for iteration in range(max_iter):
@@ -58,8 +211,14 @@ def iterative_monolayer_resolution_parameter_estimation(G, gamma=1.0, tol=1e-2,
             raise ValueError("gamma={:.3f} resulted in degenerate partition".format(gamma))
 
         last_gamma = gamma
-        gamma = update_gamma(omega_in, omega_out)
+        # omega_out is 0 for a single community partition, in which case only log(omega_in) remains
+        log_omega_ratio = log(omega_in) - log(omega_out) if omega_out > 0 else log(omega_in)
+        if log_omega_ratio == 0:
+            # omega_in == omega_out, so the partition carries no information about gamma
+            raise ValueError("gamma={:.3f} resulted in degenerate partition".format(gamma))
+        gamma = update_gamma(omega_in, omega_out, log_omega_ratio)
 
+        # Q is computed from scratch on first access, so it is only touched when it is printed
         if verbose:
             print("Iter {:>2}: {} communities with Q={:.3f} and "
                   "gamma={:.3f}->{:.3f}".format(iteration, len(part), part.q, last_gamma, gamma))
@@ -77,7 +236,35 @@ def iterative_monolayer_resolution_parameter_estimation(G, gamma=1.0, tol=1e-2,
     return gamma, part
 
 
-def check_multilayer_graph_consistency(G_intralayer, G_interlayer, layer_vec, model, m_t, T, N=None, Nt=None):
+def _update_omega_ordinal(log_theta_ratio, log_coupling, T):
+    """
+    Omega update for temporal and multilevel networks, where nodes are coupled to adjacent layers.
+
+    :param log_theta_ratio: log(theta_in) - log(theta_out)
+    :param log_coupling: log(1 + p * K / (1 - p)) for the estimated persistence probability p and K communities
+    :param T: number of layers (unused for these models)
+    """
+    return log_coupling / (2 * log_theta_ratio)
+
+
+def _update_omega_categorical(log_theta_ratio, log_coupling, T):
+    """
+    Omega update for multiplex networks, where nodes are coupled to themselves in every other layer.
+
+    :param log_theta_ratio: log(theta_in) - log(theta_out)
+    :param log_coupling: log(1 + p * K / (1 - p)) for the estimated persistence probability p and K communities
+    :param T: number of layers
+    """
+    return log_coupling / (T * log_theta_ratio)
+
+
+_OMEGA_UPDATES = {'temporal': _update_omega_ordinal,
+                  'multilevel': _update_omega_ordinal,
+                  'multiplex': _update_omega_categorical}
+
+
+def check_multilayer_graph_consistency(G_intralayer, G_interlayer, layer_vec, model, m_t, T, N=None, Nt=None,
+                                       intralayer_edges=None):
     """
     Checks that the structures of the intralayer and interlayer graphs are consistent and match the given model.
 
@@ -89,6 +276,8 @@ def check_multilayer_graph_consistency(G_intralayer, G_interlayer, layer_vec, mo
     :param T: number of layers in input graph
     :param N: number of nodes per layer
     :param Nt: vector of nodes per layer
+    :param intralayer_edges: E x 2 array of the intralayer graph's edge endpoints, if the caller already has one
+                             (otherwise it is built from G_intralayer)
     """
 
     if G_intralayer.is_directed() != G_interlayer.is_directed():
@@ -97,6 +286,17 @@ def check_multilayer_graph_consistency(G_intralayer, G_interlayer, layer_vec, mo
                                 "directed" if G_interlayer.is_directed() else "undirected"),
                       RuntimeWarning)
 
+    # vertices are taken from the membership vector in bulk rather than edge by edge
+    if intralayer_edges is None:
+        intralayer_edges = np.array(G_intralayer.get_edgelist(), dtype=np.int32).reshape(-1, 2)
+    layer_arr = np.asarray(layer_vec)
+    cross_layer = layer_arr[intralayer_edges[:, 0]] != layer_arr[intralayer_edges[:, 1]]
+    n_cross_layer = np.count_nonzero(cross_layer)
+    cross_layer_message = "Intralayer graph should not contain edges across layers"
+    if n_cross_layer:
+        cross_layer_message += " (found {} such edges, e.g. {})".format(
+            n_cross_layer, tuple(intralayer_edges[np.argmax(cross_layer)].tolist()))
+
     rules = [T > 1,
              "Graph must have multiple layers",
              G_interlayer.vcount() == G_intralayer.vcount(),
@@ -105,19 +305,19 @@ def check_multilayer_graph_consistency(G_intralayer, G_interlayer, layer_vec, mo
              "Layer membership vector must have length matching graph size",
              all(m > 0 for m in m_t),
              "All layers of graph must contain edges",
-             all(layer_vec[e.source] == layer_vec[e.target] for e in G_intralayer.es),
-             "Intralayer graph should not contain edges across layers",
-             model is not 'temporal' or G_interlayer.ecount() == N * (T - 1),
+             n_cross_layer == 0,
+             cross_layer_message,
+             model != 'temporal' or G_interlayer.ecount() == N * (T - 1),
              "Interlayer temporal graph must contain (nodes per layer) * (number of layers - 1) edges",
-             model is not 'temporal' or (G_interlayer.vcount() % T == 0 and G_intralayer.vcount() % T == 0),
+             model != 'temporal' or (G_interlayer.vcount() % T == 0 and G_intralayer.vcount() % T == 0),
              "Vertex count of a temporal graph should be a multiple of the number of layers",
-             model is not 'temporal' or all(nt == N for nt in Nt),
+             model != 'temporal' or all(nt == N for nt in Nt),
              "Temporal networks must have the same number of nodes in every layer",
-             model is not 'multilevel' or all(nt > 0 for nt in Nt),
+             model != 'multilevel' or all(nt > 0 for nt in Nt),
              "All layers of a multilevel graph must be consecutive and nonempty",
-             model is not 'multiplex' or all(nt == N for nt in Nt),
+             model != 'multiplex' or all(nt == N for nt in Nt),
              "Multiplex networks must have the same number of nodes in every layer",
-             model is not 'multiplex' or G_interlayer.ecount() == N * T * (T - 1),
+             model != 'multiplex' or G_interlayer.ecount() == N * T * (T - 1),
              "Multiplex interlayer networks must contain edges between all pairs of layers"]
 
     checks, messages = rules[::2], rules[1::2]
@@ -133,6 +333,9 @@ def iterative_multilayer_resolution_parameter_estimation(G_intralayer, G_interla
     Multilayer variant of ALG. 1 from "Relating modularity maximization and stochastic block models in multilayer
     networks." The nested functions here are just used to match the pseudocode in the paper.
 
+    The Louvain optimiser is seeded with a fixed value (where the installed louvain supports it), so repeated calls on
+    the same graphs return the same result.
+
     :param G_intralayer: input graph containing all intra-layer edges
     :param G_interlayer: input graph containing all inter-layer edges
     :param layer_vec: vector of each vertex's layer membership
@@ -143,96 +346,119 @@ def iterative_multilayer_resolution_parameter_estimation(G_intralayer, G_interla
     :param max_iter: maximum number of iterations
     :param omega_max: maximum allowed value for omega
     :param model: network layer topology (temporal, multilevel, multiplex)
-    :param verbose: whether or not to print verbose output
+    :param verbose: whether or not to print verbose output (this computes the modularity of every partition found,
+                    an extra pass over the edges per iteration)
     :return: gamma, omega to which the iteration converged and the resulting partition
     """
 
     if 'weight' not in G_intralayer.es:
-        G_intralayer.es['weight'] = [1.0] * G_intralayer.ecount()
-
-    G_interlayer.es['weight'] = [omega] * G_interlayer.ecount()
-    T = max(layer_vec) + 1  # layer count
+        G_intralayer.es['weight'] = 1.0
+
+    G_interlayer.es['weight'] = omega
+    layer_arr = np.ascontiguousarray(layer_vec, dtype=np.int32)
+    T = int(layer_arr.max()) + 1  # layer count
+
+    # edge endpoints and weights do not change between iterations, so they are gathered into arrays once
+    edges = np.array(G_intralayer.get_edgelist(), dtype=np.int32).reshape(-1, 2)
+    srcs, tgts = edges[:, 0], edges[:, 1]
+    ws = np.asarray(G_intralayer.es['weight'], dtype=np.float64)
+    edge_layer = layer_arr[srcs]
+
+    # intralayer edges are grouped by layer, so that each layer's edges form a contiguous slice
+    order = np.argsort(edge_layer, kind='stable')
+    srcs, tgts, ws, edge_layer = srcs[order], tgts[order], ws[order], edge_layer[order]
+    layer_offsets = np.concatenate(([0], np.cumsum(np.bincount(edge_layer, minlength=T))))
+    m_t = np.bincount(edge_layer, weights=ws, minlength=T)
+    total_weight = 2 * float(m_t.sum())
+    m_t_in, kappa_buffer, partial_buffer = np.zeros(T), _ScratchBuffer(), _ScratchBuffer()
+    last_estimate = [None, None]  # membership (as bytes) and the estimates computed for it
     optimiser = louvain.Optimiser()
-    m_t = [0] * T
-    for e in G_intralayer.es:
-        m_t[layer_vec[e.source]] += e['weight']
 
     N = G_intralayer.vcount() // T
-    Nt = [0] * T
-    for l in layer_vec:
-        Nt[l] += 1
-
-    check_multilayer_graph_consistency(G_intralayer, G_interlayer, layer_vec, model, m_t, T, N, Nt)
-
-    if model is 'multiplex':
-        def update_omega(theta_in, theta_out, p, K):
-            if theta_out == 0:
-                return log(1 + p * K / (1 - p)) / (T * log(theta_in)) if p < 1.0 else omega_max
-            # if p is 1, the optimal omega is infinite (here, omega_max)
-            return log(1 + p * K / (1 - p)) / (T * (log(theta_in) - log(theta_out))) if p < 1.0 else omega_max
-    else:
-        def update_omega(theta_in, theta_out, p, K):
-            if theta_out == 0:
-                return log(1 + p * K / (1 - p)) / (2 * log(theta_in)) if p < 1.0 else omega_max
-            # if p is 1, the optimal omega is infinite (here, omega_max)
-            return log(1 + p * K / (1 - p)) / (2 * (log(theta_in) - log(theta_out))) if p < 1.0 else omega_max
+    Nt = np.bincount(layer_arr, minlength=T)
+
+    check_multilayer_graph_consistency(G_intralayer, G_interlayer, layer_arr, model, m_t, T, N, Nt, edges)
+
+    inter_edges = np.array(G_interlayer.get_edgelist(), dtype=np.int32).reshape(-1, 2)
+    inter_srcs, inter_tgts = inter_edges[:, 0], inter_edges[:, 1]
 
     # TODO: non-uniform cases
     # model affects SBM parameter estimation and the updating of omega
-    if model is 'temporal':
+    if model == 'temporal':
         def calculate_persistence(community):
             # ordinal persistence
-            return sum(community[e.source] == community[e.target] for e in G_interlayer.es) / (N * (T - 1))
-    elif model is 'multilevel':
+            return np.count_nonzero(community[inter_srcs] == community[inter_tgts]) / (N * (T - 1))
+    elif model == 'multilevel':
+        inter_tgt_layer = layer_arr[inter_tgts]
+
         def calculate_persistence(community):
             # multilevel persistence
-            pers_per_layer = [0] * T
-            for e in G_interlayer.es:
-                pers_per_layer[layer_vec[e.target]] += (community[e.source] == community[e.target])
-
-            pers_per_layer = [pers_per_layer[l] / Nt[l] for l in range(T)]
-            return sum(pers_per_layer) / (T - 1)
-    elif model is 'multiplex':
+            pers_per_layer = np.bincount(inter_tgt_layer, weights=community[inter_srcs] == community[inter_tgts],
+                                         minlength=T)
+            return float((pers_per_layer / Nt).sum()) / (T - 1)
+    elif model == 'multiplex':
         def calculate_persistence(community):
             # categorical persistence
-            return sum(community[e.source] == community[e.target] for e in G_interlayer.es) / (N * T * (T - 1))
+            return np.count_nonzero(community[inter_srcs] == community[inter_tgts]) / (N * T * (T - 1))
     else:
         raise ValueError("Model {} is not temporal, multilevel, or multiplex".format(model))
+    update_omega = _OMEGA_UPDATES[model]
+
+    # RBConfigurationVertexPartitionWeightedLayers implements a multilayer version of "standard" modularity (i.e.
+    # the Reichardt and Bornholdt's Potts model with configuration null model). It is constructed once, since doing so
+    # parses layer_vec and the intralayer weights, and is retargeted to each new gamma afterwards. As its membership
+    # changes in place, its cached Q has to be recalculated before being reported.
+    intralayer_part = louvain.RBConfigurationVertexPartitionWeightedLayers(G_intralayer, layer_vec=layer_vec,
+                                                                           weights='weight',
+                                                                           resolution_parameter=gamma)
+    singletons = list(range(G_intralayer.vcount()))
+
+    # memberships already found in this run, keyed by rounded (gamma, omega), so that revisiting a parameter pair does
+    # not rerun the optimization
+    memberships = {}
 
     def maximize_modularity(intralayer_resolution, interlayer_resolution):
-        # RBConfigurationVertexPartitionWeightedLayers implements a multilayer version of "standard" modularity (i.e.
-        # the Reichardt and Bornholdt's Potts model with configuration null model).
-        G_interlayer.es['weight'] = interlayer_resolution
-        intralayer_part = \
-            louvain.RBConfigurationVertexPartitionWeightedLayers(G_intralayer, layer_vec=layer_vec, weights='weight',
-                                                                 resolution_parameter=intralayer_resolution)
+        key = (round(intralayer_resolution, 6), round(interlayer_resolution, 6))
+        intralayer_part.resolution_parameter = intralayer_resolution
+        G_interlayer.es['weight'] = interlayer_resolution  # igraph broadcasts a scalar to every edge
+        if key in memberships:
+            intralayer_part.set_membership(memberships[key])
+            return intralayer_part
+
+        # start from singletons, as a newly constructed partition would
+        intralayer_part.set_membership(singletons)
+        # interlayer weights depend on omega, so this partition has to be rebuilt every time
         interlayer_part = louvain.CPMVertexPartition(G_interlayer, resolution_parameter=0.0, weights='weight')
+        # reseeded on every run, so that the partition depends only on (gamma, omega) and not on earlier iterations
+        if hasattr(optimiser, 'set_rng_seed'):
+            optimiser.set_rng_seed(_RNG_SEED)
         optimiser.optimise_partition_multiplex([intralayer_part, interlayer_part])
+        memberships[key] = intralayer_part.membership
         return intralayer_part
 
     def estimate_SBM_parameters(partition):
         K = len(partition)
 
-        community = partition.membership
-        m_t_in = [0] * T
-        for e in G_intralayer.es:
-            if community[e.source] == community[e.target] and layer_vec[e.source] == layer_vec[e.target]:
-                m_t_in[layer_vec[e.source]] += e['weight']
-
-        kappa_t_r_list = [[0] * K for _ in range(T)]
-        for e in G_intralayer.es:
-            layer = layer_vec[e.source]
-            kappa_t_r_list[layer][community[e.source]] += e['weight']
-            kappa_t_r_list[layer][community[e.target]] += e['weight']
-        sum_kappa_t_sqr = [sum(x ** 2 for x in kappa_t_r_list[t]) for t in range(T)]
-
-        theta_in = sum(2 * m_t_in[t] for t in range(T)) / sum(sum_kappa_t_sqr[t] / (2 * m_t[t]) for t in range(T))
+        community = _membership_array(partition)
+        # the graphs are fixed, so the estimates only change if the membership does
+        membership_key = community.tobytes()
+        if membership_key == last_estimate[0]:
+            return last_estimate[1]
+
+        m_t_in.fill(0)
+        kappa_t_r = kappa_buffer.zeros(T, K)
+        _intralayer_sums(srcs, tgts, ws, edge_layer, layer_offsets, community, m_t_in, kappa_t_r, partial_buffer)
+        sum_kappa_t_sqr = np.einsum('tr,tr->t', kappa_t_r, kappa_t_r)
+        # sum_t(2 * m_t - x_t) is 2 * sum_t(m_t) - sum_t(x_t), so theta_out reuses the totals of theta_in
+        in_weight = 2 * float(m_t_in.sum())
+        expected_in_weight = float((sum_kappa_t_sqr / (2 * m_t)).sum())
+
+        theta_in = in_weight / expected_in_weight
         # guard for div by zero with single community partition
-        theta_out = sum(2 * m_t[t] - 2 * m_t_in[t] for t in range(T)) / \
-                    sum(2 * m_t[t] - sum_kappa_t_sqr[t] / (2 * m_t[t]) for t in range(T)) if K > 1 else 0
+        theta_out = (total_weight - in_weight) / (total_weight - expected_in_weight) if K > 1 else 0
 
         pers = calculate_persistence(community)
-        if model is 'multiplex':
+        if model == 'multiplex':
             # estimate p by solving polynomial root-finding problem with starting estimate p=0.5
             def f(x):
                 coeff = 2 * (1 - 1 / K) / (T * (T - 1))
@@ -246,12 +472,11 @@ def iterative_multilayer_resolution_parameter_estimation(G_intralayer, G_interla
             # (in this case, all community assignments persist across layers)
             p = max((K * pers - 1) / (K - 1), 0) if pers < 1.0 and K > 1 else 1.0
 
+        last_estimate[:] = membership_key, (theta_in, theta_out, p, K)
         return theta_in, theta_out, p, K
 
-    def update_gamma(theta_in, theta_out):
-        if theta_out == 0:
-            return theta_in / log(theta_in)
-        return (theta_in - theta_out) / (log(theta_in) - log(theta_out))
+    def update_gamma(theta_in, theta_out, log_theta_ratio):
+        return (theta_in - theta_out) / log_theta_ratio
 
     part, K, last_gamma, last_omega = (None,) * 4
     for iteration in range(max_iter):
@@ -266,12 +491,23 @@ def iterative_multilayer_resolution_parameter_estimation(G_intralayer, G_interla
                              "".format(gamma, omega, p))
 
         last_gamma, last_omega = gamma, omega
-        gamma = update_gamma(theta_in, theta_out)
-        omega = update_omega(theta_in, theta_out, p, K)
+        # log(theta_in) - log(theta_out) is shared by both updates (theta_out is 0 for a single community partition, in
+        # which case only log(theta_in) remains)
+        log_theta_ratio = log(theta_in) - log(theta_out) if theta_out > 0 else log(theta_in)
+        if log_theta_ratio == 0:
+            # theta_in == theta_out, so the partition carries no information about gamma or omega
+            raise ValueError("gamma={:.3f}, omega={:.3f} resulted in degenerate partition".format(gamma, omega))
+        gamma = update_gamma(theta_in, theta_out, log_theta_ratio)
+        if p < 1.0:
+            # log1p stays accurate when p * K / (1 - p) is small
+            omega = update_omega(log_theta_ratio, log1p(p * K / (1 - p)), T)
+        else:
+            omega = omega_max  # if p is 1, the optimal omega is infinite (here, omega_max)
 
+        # Q is recomputed over all edges, so it is only touched when it is printed
         if verbose:
             print("Iter {:>2}: {} communities with Q={:.3f}, gamma={:.3f}->{:.3f}, omega={:.3f}->{:.3f}, and p={:.3f}"
-                  "".format(iteration, K, part.q, last_gamma, gamma, last_omega, omega, p))
+                  "".format(iteration, K, part.recalculate_modularity(), last_gamma, gamma, last_omega, omega, p))
 
         if abs(gamma - last_gamma) < gamma_tol and abs(omega - last_omega) < omega_tol:
             break  # gamma and omega converged
@@ -283,6 +519,6 @@ def iterative_multilayer_resolution_parameter_estimation(G_intralayer, G_interla
 
     if verbose:
         print("Returned {} communities with Q={:.3f}, gamma={:.3f}, "
-              "and omega={:.3f}".format(K, part.q, gamma, omega))
+              "and omega={:.3f}".format(K, part.recalculate_modularity(), gamma, omega))
 
     return gamma, omega, part